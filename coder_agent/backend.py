@@ -1,59 +1,319 @@
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import time
 from abc import ABC, abstractmethod
+from collections.abc import AsyncGenerator
+from typing import Any
 
 import dotenv
-from groq import Groq
-from openai import OpenAI
+import httpx
+from groq import AsyncGroq
+from openai import AsyncOpenAI
 
 dotenv.load_dotenv(dotenv.find_dotenv())
 
+HTTP_CLIENT = httpx.AsyncClient(
+    # HTTP/2 lets concurrent requests share a connection, but needs the optional h2 package.
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+"""The connection pool shared by the clients of all backends."""
+
+STOP_SEQUENCES = ["\n```\n\n"]
+"""The answers should be a single code block, so stop at a closing fence followed by a blank
+line, where an explanation of the code would start.  This can't match inside JSON answers, as
+newlines are escaped in JSON strings."""
+
 
 class Backend(ABC):
     """A backend for a large language model."""
 
+    model: str
+    temperature: float
+    max_tokens: int
+    prompt_tokens: int = 0
+    """The total number of prompt tokens sent to the LLM."""
+    cached_prompt_tokens: int = 0
+    """The number of prompt tokens which hit the provider's prompt cache."""
+
     @abstractmethod
-    def chat_completion(self, messages: list[dict[str, str]]) -> str:
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
         """Send a list of messages to the LLM and return the response."""
 
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        """Send a list of messages to the LLM and yield the response as it is generated.
+
+        Closing the iterator early stops the generation.  By default the whole response is
+        yielded at once.
+        """
+        yield await self.chat_completion(messages)
+
+    def record_usage(self, usage: Any) -> None:
+        """Add the token usage reported in a response to the totals."""
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens
+        # Only reported by newer versions of the SDKs.
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_prompt_tokens += getattr(details, "cached_tokens", None) or 0
+
 
 class OpenaiBackend(Backend):
     """A backend for OpenAI."""
 
-    client: OpenAI
+    client: AsyncOpenAI
     model: str = "gpt-4o-mini"
     temperature: float = 0.0
     max_tokens: int = 1500
 
-    def __init__(self) -> None:
-        self.client = OpenAI()
+    def __init__(self, api_key: str | None = None) -> None:
+        self.client = AsyncOpenAI(api_key=api_key, http_client=HTTP_CLIENT)
 
-    def chat_completion(self, messages: list[dict[str, str]]) -> str:
-        response = self.client.chat.completions.create(
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=messages,  # type: ignore
             max_tokens=self.max_tokens,  # type: ignore
             temperature=self.temperature,
+            stop=STOP_SEQUENCES,
         )
+        self.record_usage(response.usage)
         answer = response.choices[0].message.content or ""
         return answer.strip()
 
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,  # type: ignore
+            max_tokens=self.max_tokens,  # type: ignore
+            temperature=self.temperature,
+            stop=STOP_SEQUENCES,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            async for chunk in stream:
+                # The usage is only sent in the last chunk, after the whole response.
+                self.record_usage(chunk.usage)
+                if chunk.choices and (content := chunk.choices[0].delta.content):
+                    yield content
+        finally:
+            await stream.close()
+
+
+class OpenaiBatchBackend(OpenaiBackend):
+    """A backend for OpenAI which can also send many requests at once through the Batch API.
+
+    The Batch API costs half as much and has separate rate limits, but a batch may take up to
+    24 hours to complete, so it is only suitable for offline runs.  Single requests are sent
+    as usual.
+    """
+
+    poll_interval: float = 30.0
+    """The number of seconds to wait between checking the status of a batch."""
+
+    async def chat_completion_batch(
+        self, conversations: list[list[dict[str, str]]]
+    ) -> list[str | None]:
+        """Send a list of conversations through the Batch API and return the responses.
+
+        The responses are in the same order as the conversations, with None for requests
+        which failed.
+        """
+        requests = [
+            {
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": messages,
+                    "max_tokens": self.max_tokens,
+                    "temperature": self.temperature,
+                    "stop": STOP_SEQUENCES,
+                },
+            }
+            for i, messages in enumerate(conversations)
+        ]
+        input_file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(map(json.dumps, requests)).encode()), purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(self.poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+        answers: list[str | None] = [None] * len(conversations)
+        # An expired or cancelled batch may still have finished some of the requests.
+        if batch.output_file_id is None:
+            return answers
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            response = result.get("response")
+            if response is None or response["status_code"] != 200:
+                continue
+            body = response["body"]
+            self.prompt_tokens += body["usage"]["prompt_tokens"]
+            answer = body["choices"][0]["message"]["content"] or ""
+            answers[int(result["custom_id"])] = answer.strip()
+        return answers
+
 
 class GroqBackend(Backend):
     """A backend for Groq."""
 
-    client: Groq
+    client: AsyncGroq
     model: str = "llama3-70b-8192"
     temperature: float = 0.0
     max_tokens: int = 1500
 
-    def __init__(self) -> None:
-        self.client = Groq()
+    def __init__(self, api_key: str | None = None) -> None:
+        self.client = AsyncGroq(api_key=api_key, http_client=HTTP_CLIENT)
 
-    def chat_completion(self, messages: list[dict[str, str]]) -> str:
-        response = self.client.chat.completions.create(
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=messages,  # type: ignore
             max_tokens=self.max_tokens,  # type: ignore
             temperature=self.temperature,
+            stop=STOP_SEQUENCES,
         )
+        self.record_usage(response.usage)
         answer = response.choices[0].message.content or ""
         return answer.strip()
+
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,  # type: ignore
+            max_tokens=self.max_tokens,  # type: ignore
+            temperature=self.temperature,
+            stop=STOP_SEQUENCES,
+            stream=True,
+        )
+        try:
+            async for chunk in stream:  # type: ignore[union-attr]
+                # Groq sends the usage with its own metadata, in the last chunk.
+                if chunk.x_groq is not None:
+                    self.record_usage(chunk.x_groq.usage)
+                if chunk.choices and (content := chunk.choices[0].delta.content):
+                    yield content
+        finally:
+            await stream.close()  # type: ignore[union-attr]
+
+
+def api_keys(variable: str) -> list[str]:
+    """Read several API keys from the environment.
+
+    The keys are either listed comma separated in `variable`S or given in the variables
+    `variable`_1, `variable`_2, and so on.
+    """
+    if listed := os.environ.get(f"{variable}S"):
+        return [key.strip() for key in listed.split(",") if key.strip()]
+    keys: list[str] = []
+    while key := os.environ.get(f"{variable}_{len(keys) + 1}"):
+        keys.append(key)
+    return keys
+
+
+class RateLimiter:
+    """A token bucket which allows `max_rate` requests per `time_period` seconds."""
+
+    max_rate: float
+    time_period: float
+    tokens: float
+    updated: float
+
+    def __init__(self, max_rate: float, time_period: float = 60.0) -> None:
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self.tokens = max_rate
+        self.updated = time.monotonic()
+
+    def available(self) -> float:
+        """Refill the bucket and return the number of requests which can be made right now."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.max_rate, self.tokens + (now - self.updated) * self.max_rate / self.time_period
+        )
+        self.updated = now
+        return self.tokens
+
+    async def acquire(self) -> None:
+        """Wait until a request can be made and take a token for it."""
+        while (tokens := self.available()) < 1:
+            await asyncio.sleep((1 - tokens) * self.time_period / self.max_rate)
+        self.tokens -= 1
+
+
+class RoundRobinBackend(Backend):
+    """Spreads the requests over several backends, e.g. one per API key.
+
+    Each backend has its own rate limiter, and every request goes to the backend with the
+    most capacity left, so the throughput grows with the number of backends until all of
+    them hit their rate limits.  The token usage is recorded by the individual backends.
+    """
+
+    backends: list[Backend]
+    limiters: list[RateLimiter]
+
+    def __init__(self, backends: list[Backend], requests_per_minute: float = 500) -> None:
+        self.backends = backends
+        self.limiters = [RateLimiter(requests_per_minute) for _ in backends]
+
+    @property
+    def model(self) -> str:
+        return self.backends[0].model
+
+    @model.setter
+    def model(self, model: str) -> None:
+        for backend in self.backends:
+            backend.model = model
+
+    @property
+    def temperature(self) -> float:
+        return self.backends[0].temperature
+
+    @temperature.setter
+    def temperature(self, temperature: float) -> None:
+        for backend in self.backends:
+            backend.temperature = temperature
+
+    @property
+    def max_tokens(self) -> int:
+        return self.backends[0].max_tokens
+
+    @max_tokens.setter
+    def max_tokens(self, max_tokens: int) -> None:
+        for backend in self.backends:
+            backend.max_tokens = max_tokens
+
+    async def pick(self) -> Backend:
+        """Wait for the backend with the most capacity left and return it."""
+        i = max(range(len(self.backends)), key=lambda i: self.limiters[i].available())
+        await self.limiters[i].acquire()
+        return self.backends[i]
+
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
+        backend = await self.pick()
+        return await backend.chat_completion(messages)
+
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        backend = await self.pick()
+        async with contextlib.aclosing(backend.chat_completion_stream(messages)) as stream:
+            async for chunk in stream:
+                yield chunk
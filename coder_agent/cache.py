@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import array
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import math
+import operator
+import sqlite3
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from pathlib import Path
+
+from openai import APIError, AsyncOpenAI
+
+from .backend import HTTP_CLIENT, Backend
+
+
+@functools.lru_cache(maxsize=4096)
+def content_digest(content: str) -> bytes:
+    """Hash the content of a message.
+
+    Memoized, as the system prompts and the earlier turns of a conversation are the same in
+    many requests.  Python caches the hash of a str object, so a hit on a shared prompt
+    costs a dictionary lookup rather than hashing the whole text again.
+    """
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+class SQLiteCache:
+    """A persistent store for LLM responses, keyed by a hash of the request."""
+
+    connection: sqlite3.Connection
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+        )
+
+    def get(self, key: str) -> str | None:
+        row = self.connection.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, response: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response)
+            )
+
+
+class CachedBackend(Backend):
+    """Wraps another backend and caches its responses.
+
+    Responses are kept in an in-memory LRU cache and, if `persistent` is given, in a
+    `SQLiteCache` so that they survive across runs.  The cache key covers the model,
+    temperature, max tokens and messages, so changing any of them results in a new request.
+    Only requests with temperature 0 are cached, at higher temperatures the caller expects
+    a new sample every time.
+    """
+
+    backend: Backend
+    persistent: SQLiteCache | None
+    maxsize: int
+    memory: OrderedDict[str, str]
+
+    def __init__(
+        self, backend: Backend, persistent: SQLiteCache | None = None, maxsize: int = 2048
+    ) -> None:
+        self.backend = backend
+        self.persistent = persistent
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+
+    @property
+    def model(self) -> str:
+        return self.backend.model
+
+    @model.setter
+    def model(self, model: str) -> None:
+        self.backend.model = model
+
+    @property
+    def temperature(self) -> float:
+        return self.backend.temperature
+
+    @temperature.setter
+    def temperature(self, temperature: float) -> None:
+        self.backend.temperature = temperature
+
+    @property
+    def max_tokens(self) -> int:
+        return self.backend.max_tokens
+
+    @max_tokens.setter
+    def max_tokens(self, max_tokens: int) -> None:
+        self.backend.max_tokens = max_tokens
+
+    def key(self, messages: list[dict[str, str]], stream: bool = False) -> str:
+        """Compute the cache key for a request with the given messages.
+
+        Streamed responses get their own keys as they may have been cut short by the caller.
+        """
+        digest = hashlib.blake2b(
+            json.dumps([self.model, self.temperature, self.max_tokens, stream]).encode()
+        )
+        for message in messages:
+            digest.update(message["role"].encode())
+            digest.update(content_digest(message["content"]))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Look up a response in the in-memory cache and then in the persistent cache."""
+        if (answer := self.memory.get(key)) is not None:
+            self.memory.move_to_end(key)
+            return answer
+        if self.persistent is not None and (answer := self.persistent.get(key)) is not None:
+            self.remember(key, answer)
+        return answer
+
+    def put(self, key: str, answer: str) -> None:
+        """Store a response in the in-memory cache and in the persistent cache."""
+        if self.persistent is not None:
+            self.persistent.put(key, answer)
+        self.remember(key, answer)
+
+    def remember(self, key: str, answer: str) -> None:
+        """Store a response in the in-memory cache, evicting the least recently used one."""
+        self.memory[key] = answer
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
+        if self.temperature != 0:
+            return await self.backend.chat_completion(messages)
+        key = self.key(messages)
+        if (answer := self.get(key)) is None:
+            answer = await self.backend.chat_completion(messages)
+            self.put(key, answer)
+        return answer
+
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        if self.temperature != 0:
+            async with contextlib.aclosing(self.backend.chat_completion_stream(messages)) as stream:
+                async for chunk in stream:
+                    yield chunk
+            return
+        key = self.key(messages, stream=True)
+        if (answer := self.get(key)) is not None:
+            yield answer
+            return
+        chunks: list[str] = []
+        async with contextlib.aclosing(self.backend.chat_completion_stream(messages)) as stream:
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                # The caller has all it wanted, so cache what it got.
+                self.put(key, "".join(chunks))
+                raise
+        self.put(key, "".join(chunks))
+
+
+class SemanticCachedBackend(Backend):
+    """Wraps another backend and reuses the response to an earlier, similar request.
+
+    The messages of each request are embedded with OpenAI's embedding API, and if an
+    earlier request with the same parameters has a cosine similarity of at least
+    `threshold`, its response is returned without asking the LLM.  This catches retries
+    which only differ slightly in the error messages, but the old response may of course
+    not fit the new request, so it should be used with a high threshold.  If `path` is
+    given, the embeddings are stored in an SQLite database there so that they survive
+    across runs.  Like `CachedBackend`, only requests with temperature 0 are cached.  If the
+    messages can't be embedded, the request is sent to the backend without the cache.
+    """
+
+    backend: Backend
+    threshold: float
+    client: AsyncOpenAI
+    embedding_model: str = "text-embedding-3-small"
+    max_embedding_input: int = 16_000
+    """The number of characters at the end of a conversation which are embedded, to stay
+    within the 8191 tokens the embedding model accepts."""
+    connection: sqlite3.Connection | None
+    entries: list[tuple[str, array.array[float], str]]
+    """The request parameters, normalized embedding and response of every cached request."""
+
+    def __init__(self, backend: Backend, threshold: float, path: Path | None = None) -> None:
+        self.backend = backend
+        self.threshold = threshold
+        self.client = AsyncOpenAI(http_client=HTTP_CLIENT)
+        self.connection = None
+        self.entries = []
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(params TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL)"
+            )
+            for params, embedding, response in self.connection.execute(
+                "SELECT params, embedding, response FROM embeddings"
+            ):
+                self.entries.append((params, array.array("f", embedding), response))
+
+    @property
+    def model(self) -> str:
+        return self.backend.model
+
+    @model.setter
+    def model(self, model: str) -> None:
+        self.backend.model = model
+
+    @property
+    def temperature(self) -> float:
+        return self.backend.temperature
+
+    @temperature.setter
+    def temperature(self, temperature: float) -> None:
+        self.backend.temperature = temperature
+
+    @property
+    def max_tokens(self) -> int:
+        return self.backend.max_tokens
+
+    @max_tokens.setter
+    def max_tokens(self, max_tokens: int) -> None:
+        self.backend.max_tokens = max_tokens
+
+    def params(self, stream: bool) -> str:
+        """The parameters which must be equal for a cached response to be used."""
+        return json.dumps([self.model, self.temperature, self.max_tokens, stream])
+
+    async def embed(self, messages: list[dict[str, str]]) -> array.array[float] | None:
+        """Embed the messages and normalize the embedding to unit length.
+
+        Only the end of a long conversation is embedded, as that is where the requests with
+        the same beginning differ.  Returns None if the embedding request fails.
+        """
+        text = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        try:
+            response = await self.client.embeddings.create(
+                model=self.embedding_model, input=text[-self.max_embedding_input :]
+            )
+        except APIError as error:
+            print(f"Skipping the semantic cache, as the embedding failed: {error}")
+            return None
+        embedding = response.data[0].embedding
+        norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+        return array.array("f", (x / norm for x in embedding))
+
+    def get(self, params: str, embedding: array.array[float]) -> str | None:
+        """Find the response to the most similar earlier request, if it is similar enough.
+
+        This compares with every cached request, so it should be run in a worker thread.
+        """
+        best, answer = self.threshold, None
+        for entry_params, entry_embedding, response in self.entries:
+            if entry_params != params:
+                continue
+            # Both embeddings have unit length, so the dot product is the cosine similarity.
+            if (similarity := sum(map(operator.mul, embedding, entry_embedding))) >= best:
+                best, answer = similarity, response
+        return answer
+
+    def put(self, params: str, embedding: array.array[float], answer: str) -> None:
+        self.entries.append((params, embedding, answer))
+        if self.connection is not None:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO embeddings (params, embedding, response) VALUES (?, ?, ?)",
+                    (params, embedding.tobytes(), answer),
+                )
+
+    async def chat_completion(self, messages: list[dict[str, str]]) -> str:
+        embedding = await self.embed(messages) if self.temperature == 0 else None
+        if embedding is None:
+            return await self.backend.chat_completion(messages)
+        params = self.params(stream=False)
+        if (answer := await asyncio.to_thread(self.get, params, embedding)) is None:
+            answer = await self.backend.chat_completion(messages)
+            self.put(params, embedding, answer)
+        return answer
+
+    async def chat_completion_stream(
+        self, messages: list[dict[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        embedding = await self.embed(messages) if self.temperature == 0 else None
+        if embedding is None:
+            async with contextlib.aclosing(self.backend.chat_completion_stream(messages)) as stream:
+                async for chunk in stream:
+                    yield chunk
+            return
+        params = self.params(stream=True)
+        if (answer := await asyncio.to_thread(self.get, params, embedding)) is not None:
+            yield answer
+            return
+        chunks: list[str] = []
+        async with contextlib.aclosing(self.backend.chat_completion_stream(messages)) as stream:
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                # The caller has all it wanted, so cache what it got.
+                self.put(params, embedding, "".join(chunks))
+                raise
+        self.put(params, embedding, "".join(chunks))
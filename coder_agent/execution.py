@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import sys
+import traceback
+import unittest
+from multiprocessing.connection import Connection
+from pathlib import Path
+
+CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+"""Test processes are forked from a server which has already imported unittest, which is much
+faster than starting a new interpreter.  Forking the main process directly is not safe as
+mypy and the HTTP clients run in other threads.  On Windows, where there is no fork server,
+every test process is a new interpreter."""
+if CONTEXT.get_start_method() == "forkserver":
+    # The test processes run the main script again before the test, which is only cheap if
+    # the modules it imports are already loaded in the server.
+    CONTEXT.set_forkserver_preload([f"{__package__}.main"])
+
+TEST_TIMEOUT = 30.0
+"""The number of seconds the tests may run, as the code may loop forever."""
+
+
+def run_tests_in_process(tests_file: Path, connection: Connection) -> None:
+    """Load the tests in tests_file with unittest and run them.
+
+    This is the entry point of a test process.  The exit status, 0 if there were tests and
+    all of them passed, and everything written to stdout and stderr is sent back over
+    connection.
+    """
+    # The code may be rewritten within the same second with the same size, so a cached .pyc
+    # could be stale.
+    sys.dont_write_bytecode = True
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            suite = unittest.defaultTestLoader.discover(
+                str(tests_file.parent), pattern=tests_file.name
+            )
+            result = unittest.TextTestRunner(stream=output).run(suite)
+        status = 0 if result.wasSuccessful() else 1
+        if result.testsRun == 0:
+            # E.g. the tests were lost in a correction, which must not count as a pass.
+            output.write("No tests were run.\n")
+            status = 1
+    except BaseException:
+        # E.g. sys.exit() in the code.
+        output.write(traceback.format_exc())
+        status = 1
+    connection.send((status, output.getvalue()))
+
+
+async def run_tests(tests_file: Path, timeout: float = TEST_TIMEOUT) -> tuple[int, str]:
+    """Run the tests in tests_file with unittest in a new process.
+
+    Returns the exit status, 0 if all tests passed, and the output.  The process is killed
+    if this is cancelled or if the tests take longer than timeout seconds, in which case
+    the tests have failed.
+    """
+    receiver, sender = CONTEXT.Pipe(duplex=False)
+    process = CONTEXT.Process(  # type: ignore[attr-defined]
+        target=run_tests_in_process, args=(tests_file, sender), daemon=True
+    )
+    process.start()
+    sender.close()
+    try:
+        # The pipe becomes readable when the result is sent, or when the process dies.  Not
+        # waited for with the event loop, as the Windows event loop can't wait for pipes.
+        if not await asyncio.to_thread(receiver.poll, timeout):
+            return 1, f"The tests timed out after {timeout:g} seconds.\n"
+        try:
+            status, output = receiver.recv()
+        except EOFError:
+            process.join()
+            status, output = 1, f"The test process died with exit code {process.exitcode}.\n"
+    finally:
+        # Killing the process also ends the wait for the pipe if this was cancelled.
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+    return status, output
@@ -0,0 +1,35 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+FILE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="coder")
+"""The threads for file I/O, which is quick and should never wait behind slower work."""
+
+FILE_CONTENTS: dict[Path, str] = {}
+"""The text of the files which have been read with read_file(), kept up to date by
+write_file(), so that they are only read from the disk once."""
+
+
+async def write_file(path: Path, text: str) -> None:
+    """Write text to a file in a worker thread, so that other problems can make progress."""
+    await asyncio.get_running_loop().run_in_executor(FILE_EXECUTOR, path.write_text, text)
+    if path in FILE_CONTENTS:
+        FILE_CONTENTS[path] = text
+
+
+async def read_file(path: Path) -> str:
+    """Read a file in a worker thread, so that other problems can make progress.
+
+    The file is only read from the disk the first time, so it must not be changed other than
+    with write_file() until it is forgotten with forget_files().
+    """
+    if (text := FILE_CONTENTS.get(path)) is None:
+        text = await asyncio.get_running_loop().run_in_executor(FILE_EXECUTOR, path.read_text)
+        FILE_CONTENTS[path] = text
+    return text
+
+
+def forget_files(directory: Path) -> None:
+    """Drop the text of the files in directory which has been kept by read_file()."""
+    for path in [path for path in FILE_CONTENTS if path.is_relative_to(directory)]:
+        del FILE_CONTENTS[path]
@@ -3,287 +3,895 @@
 from __future__ import annotations
 
 import argparse
+import ast
+import asyncio
+import contextlib
+import hashlib
+import json
 import re
 import shutil
-import subprocess
 import textwrap
+from collections.abc import Sequence
 from pathlib import Path
 
 import human_eval.data
 
-from .backend import Backend, GroqBackend, OpenaiBackend
+from .backend import (
+    Backend,
+    GroqBackend,
+    OpenaiBackend,
+    OpenaiBatchBackend,
+    RoundRobinBackend,
+    api_keys,
+)
+from .cache import CachedBackend, SemanticCachedBackend, SQLiteCache
+from .execution import run_tests
+from .files import forget_files, read_file, write_file
+from .type_checker import TypeChecker, make_type_checker
 
-CODE_BLOCK_REGEX = re.compile(r"^```(python)?\s*$((.*\n)*)^```\s*$", flags=re.I | re.M)
+PROGRAMMER_SYSTEM_PROMPT = (
+    "You are a programmer. Write Python code to solve the user's problem. "
+    "Provide only the code, do not include explanations. "
+    "Only write functions without side effects, so no main function. "
+    "Add type annotations to all function definitions. "
+    "Write doc strings for all functions."
+)
+
+PROGRAMMER_BATCH_SYSTEM_PROMPT = (
+    PROGRAMMER_SYSTEM_PROMPT + " You will be given several problems. "
+    "Return a JSON array with one element per problem, element i is the Python code for "
+    "problem i. Provide only the JSON array."
+)
+
+TEST_DESIGNER_SYSTEM_PROMPT = (
+    "You are a test designer. Write relevant Python unit tests to "
+    "verify the correctness of code solving the user's problem. Use the unit "
+    "test framework in Python. Provide only the test code, do not include "
+    "explanations. Write type annotations for the test code. "
+    "Use math.isnan() to check if a number is NaN. "
+    "Do not use any external libraries. "
+    "Do not try with very large inputs. "
+    "Do not replicate the function definitions."
+)
+
+# The system messages are the same in every request, so they are built once and shared.
+# They must not be mutated.
+PROGRAMMER_SYSTEM_MESSAGE = {"role": "system", "content": PROGRAMMER_SYSTEM_PROMPT}
+PROGRAMMER_BATCH_SYSTEM_MESSAGE = {"role": "system", "content": PROGRAMMER_BATCH_SYSTEM_PROMPT}
+TEST_DESIGNER_SYSTEM_MESSAGE = {"role": "system", "content": TEST_DESIGNER_SYSTEM_PROMPT}
+
+OPENING_FENCE_REGEX = re.compile(r"(?P<indent>[ \t]*)```[ \t]*(?:python3?|py)?[ \t]*", flags=re.I)
+"""Matches a whole line which opens a markdown code block, capturing its indentation."""
+
+UNITTEST_TIMING_REGEX = re.compile(r"^(Ran \d+ tests?) in .*$", flags=re.M)
+"""Matches the line with the running time in the output of unittest."""
+
+UNITTEST_FAILURE_REGEX = re.compile(r"^(?:FAIL|ERROR): (.+)$", flags=re.M)
+"""Matches the heading of a failed test in the output of unittest, capturing the test."""
+
+MAX_CONVERSATION_LENGTH = 12_000
+"""The number of characters in a conversation with the programmer after which it is started
+over with a single prompt.  At roughly four characters per token this leaves room for the
+errors and the answer in a context of 8k tokens, like that of llama3-70b-8192."""
+
+TYPE_ERROR_LOCATION_REGEX = re.compile(
+    r"^(?P<path>[^\s:]+):(?:\d+:)* (?:error|warning|note|info)(?:\[[\w-]+\])?:?"
+)
+"""Matches the start of an error from the type checker, which may continue on more lines."""
+
+TYPE_CHECK_SUMMARY_REGEX = re.compile(
+    r"^(?:Found \d+ (?:errors? in|diagnostics?)|Success:|All checks passed)"
+)
+"""Matches the summary at the end of the report from the type checker."""
+
+# Templates for the user messages, to be filled in with str.format().
+PROBLEM_PROMPT = textwrap.dedent("""\
+    Problem:
+        {user_query}
+
+    Write functions with type annotations which could solve the user's problem.
+""")
+
+TYPE_ERRORS_PROMPT = textwrap.dedent("""\
+    The specification of the code is:
+        {user_query}
+
+    The code was:
+    ```
+    {code}
+    ```
+
+    However, type checking with mypy failed with the following errors:
+        {errors}
+
+    Please correct the code to make it pass type checking.
+""")
+
+TEST_ERRORS_PROMPT = textwrap.dedent("""\
+    The specification of the code is:
+        {user_query}
+
+    The code was:
+    ```
+    {code}
+    ```
+
+    However, the tests failed with the following errors:
+        {errors}
+
+    Please correct the code to make it pass the tests.
+""")
+
+# Follow-ups in a conversation where the last message from the programmer is the code.
+TYPE_ERRORS_FOLLOW_UP_PROMPT = textwrap.dedent("""\
+    Type checking with mypy failed with the following errors:
+        {errors}
+
+    Please correct the code to make it pass type checking.
+""")
+
+TEST_ERRORS_FOLLOW_UP_PROMPT = textwrap.dedent("""\
+    The tests failed with the following errors:
+        {errors}
+
+    Please correct the code to make it pass the tests.
+""")
+
+# Type errors in the tests go to the test designer, which must not drop the test cases.
+TESTS_TYPE_ERRORS_PROMPT = textwrap.dedent("""\
+    The tests are for code solving the following problem:
+        {user_query}
+
+    The test module was:
+    ```
+    {code}
+    ```
+
+    However, type checking with mypy failed with the following errors:
+        {errors}
+
+    Please correct the test module to make it pass type checking. Answer with the whole
+    module, keeping the import of the code and all the test cases.
+""")
+
+TESTS_TYPE_ERRORS_FOLLOW_UP_PROMPT = textwrap.dedent("""\
+    Type checking with mypy failed with the following errors:
+        {errors}
+
+    Please correct the test module to make it pass type checking. Answer with the whole
+    module, keeping the import of the code and all the test cases.
+""")
+
+TEST_DRAFT_PROMPT = textwrap.dedent("""\
+    Problem:
+        {user_query}
+
+    The functions solving the problem have not been written yet. Draft tests for them,
+    guessing their names and signatures from the problem.
+""")
+
+TEST_DESIGNER_PROMPT = textwrap.dedent("""\
+    Problem:
+        {user_query}
+
+    The definitions of the functions to write tests for are as follows:
+    ```
+    {stub}
+    ```
+""")
+
+TEST_REFINE_PROMPT = textwrap.dedent("""\
+
+    The following tests were drafted before the functions were written:
+    ```
+    {draft_tests}
+    ```
+
+    Refine these tests so that they match the definitions above.
+""")
+
+TEST_REVIEW_PROMPT = textwrap.dedent("""\
+    Problem:
+        {user_query}
+
+    The code solving the problem is:
+    ```
+    {code}
+    ```
+
+    The tests are:
+    ```
+    {tests}
+    ```
+
+    Some tests failed again after the code had been corrected, with the following errors:
+        {errors}
+
+    If the failing tests are wrong, please correct them. Otherwise answer with the tests
+    unchanged.
+""")
+
+
+def digest(text: str) -> str:
+    """Hash text, to recognise prompts which have been seen before."""
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def stub_body(body: list[ast.stmt]) -> list[ast.stmt]:
+    """Strip a module or class body down to what belongs in a stub.
+
+    Function bodies are replaced by their docstrings and `...`, and statements which are
+    not definitions, like tests under `if __name__ == "__main__":`, are dropped.
+    """
+    stub: list[ast.stmt] = []
+    for node in body:
+        if isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef):
+            docstring = node.body[:1] if ast.get_docstring(node) is not None else []
+            node.body = [*docstring, ast.Expr(ast.Constant(...))]
+            stub.append(node)
+        elif isinstance(node, ast.ClassDef):
+            node.body = stub_body(node.body) or [ast.Expr(ast.Constant(...))]
+            stub.append(node)
+        elif isinstance(node, ast.Import | ast.ImportFrom | ast.Assign | ast.AnnAssign):
+            stub.append(node)
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            # Docstrings.
+            stub.append(node)
+    return stub
+
+
+def generate_stub(code: str) -> str:
+    """Generate a stub for the code, with all definitions and docstrings but no function bodies.
+
+    The stub is built from the syntax tree in-process, which only takes a few milliseconds.
+    If the code can't be parsed, the code itself is returned.
+    """
+    try:
+        module = ast.parse(code)
+    except SyntaxError:
+        return code
+    module.body = stub_body(module.body)
+    return ast.unparse(module)
+
+
+def closes_block(line: str, indent: str) -> bool:
+    """Check if line is a fence which closes a code block opened with the given indentation.
+
+    A more indented fence is part of the code, e.g. in a docstring with a markdown example.
+    """
+    stripped = line.lstrip(" \t")
+    return stripped.rstrip() == "```" and len(line) - len(stripped) <= len(indent)
 
 
 def clean_code(code: str) -> str:
     """Clean the code by removing unwanted markdown markers or other invalid syntax.
     This will ensure the code is valid Python code.
+
+    If the code contains a markdown code block, the contents of the first one is returned,
+    dedented in case the block was indented, e.g. in a list.  A block which is never closed,
+    e.g. because the generation was stopped at the closing fence, runs to the end.  This is
+    a single linear scan over the lines, so it is fast even on long malformed outputs.
+    """
+    lines = code.splitlines(keepends=True)
+    start: int | None = None
+    indent = ""
+    for i, line in enumerate(lines):
+        if start is None:
+            if match := OPENING_FENCE_REGEX.fullmatch(line.rstrip("\r\n")):
+                start, indent = i + 1, match["indent"]
+        elif closes_block(line, indent):
+            return textwrap.dedent("".join(lines[start:i]))
+    return code if start is None else textwrap.dedent("".join(lines[start:]))
+
+
+class StreamingCodeBlockExtractor:
+    """Finds the first markdown code block in a response which is being streamed.
+
+    Feed the chunks of the response to feed() until it returns True, which it does as soon
+    as the code block has been closed.  The rest of the response is not needed then.
+    """
+
+    text: str
+    scanned: int
+    indent: str | None
+    """The indentation of the opening fence, or None before the code block."""
+    done: bool
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.scanned = 0  # Index of the first line which has not been scanned yet.
+        self.indent = None
+        self.done = False
+
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk of the response and return True if the code block is complete."""
+        self.text += chunk
+        while not self.done and (end := self.text.find("\n", self.scanned)) >= 0:
+            line = self.text[self.scanned : end].rstrip("\r")
+            self.scanned = end + 1
+            if self.indent is None:
+                if match := OPENING_FENCE_REGEX.fullmatch(line):
+                    self.indent = match["indent"]
+            else:
+                self.done = closes_block(line, self.indent)
+        return self.done
+
+    @property
+    def code(self) -> str:
+        """The code in the response received so far, as returned by clean_code()."""
+        return clean_code(self.text)
+
+
+async def complete_code(backend: Backend, messages: list[dict[str, str]]) -> str:
+    """Send the messages to the LLM and return the code in the response.
+
+    The response is streamed, and the stream is closed as soon as the first code block is
+    complete so that no time is spent waiting for explanations after the code.
+    """
+    extractor = StreamingCodeBlockExtractor()
+    async with contextlib.aclosing(backend.chat_completion_stream(messages)) as stream:
+        async for chunk in stream:
+            if extractor.feed(chunk):
+                break
+    return extractor.code.strip()
+
+
+def programmer_messages(user_query: str) -> list[dict[str, str]]:
+    user_message = {"role": "user", "content": user_query}
+    return [PROGRAMMER_SYSTEM_MESSAGE, user_message]
+
+
+async def programmer_agent(
+    backend: Backend, messages: list[dict[str, str]], user_query: str
+) -> str:
+    """Continue a conversation with the programmer agent and return the code in the answer.
+
+    The query and the answer are appended to messages.  The conversation about a file
+    grows across retries, so every request starts with the previous one, which lets the
+    provider's prompt cache reuse it, until it gets too long, see continues_with().
     """
-    if (code_block_match := CODE_BLOCK_REGEX.search(code)) is not None:
-        return code_block_match.group(2)
+    messages.append({"role": "user", "content": user_query})
+    code = await complete_code(backend, messages)
+    messages.append({"role": "assistant", "content": code})
     return code
 
 
-def programmer_agent(backend: Backend, user_query: str) -> str:
-    system_message = {
-        "role": "system",
-        "content": "You are a programmer. Write Python code to solve the user's problem. "
-        "Provide only the code, do not include explanations. "
-        "Only write functions without side effects, so no main function. "
-        "Add type annotations to all function definitions. "
-        "Write doc strings for all functions.",
+def continues_with(messages: list[dict[str, str]], code: str) -> bool:
+    """Whether the conversation can be continued with a follow-up about the code.
+
+    The last message must be the code from the programmer, and the conversation must be
+    shorter than MAX_CONVERSATION_LENGTH.
+    """
+    return (
+        messages[-1] == {"role": "assistant", "content": code}
+        and sum(len(message["content"]) for message in messages) < MAX_CONVERSATION_LENGTH
+    )
+
+
+async def programmer_agent_batch_api(
+    backend: OpenaiBatchBackend, user_queries: list[str]
+) -> list[str | None]:
+    """Ask the programmer agent to solve several problems through OpenAI's Batch API.
+
+    Returns the code for each problem in the same order as user_queries, with None for the
+    problems whose requests failed.
+    """
+    answers = await backend.chat_completion_batch([
+        programmer_messages(PROBLEM_PROMPT.format(user_query=query)) for query in user_queries
+    ])
+    return [None if answer is None else clean_code(answer).strip() for answer in answers]
+
+
+async def programmer_agent_batch(backend: Backend, user_queries: list[str]) -> list[str] | None:
+    """Ask the programmer agent to solve several independent problems in one request.
+
+    Returns the code for each problem in the same order as user_queries, or None if the
+    response could not be parsed, in which case the problems should be solved one by one.
+    """
+    problems = "\n\n".join(
+        f"Problem {i}:\n{textwrap.indent(query, ' ' * 4)}" for i, query in enumerate(user_queries)
+    )
+    user_message = {
+        "role": "user",
+        "content": problems + "\n\nWrite functions with type annotations which could solve "
+        f"each of the user's problems. Return a JSON array of length {len(user_queries)}.",
     }
-    user_message = {"role": "user", "content": user_query}
-    messages = [system_message, user_message]
-    code = backend.chat_completion(messages)
-    return clean_code(code)  # Clean the code before returning
+    response = await backend.chat_completion([PROGRAMMER_BATCH_SYSTEM_MESSAGE, user_message])
+    try:
+        codes = json.loads(response[response.find("[") : response.rfind("]") + 1])
+    except json.JSONDecodeError:
+        return None
+    if (
+        not isinstance(codes, list)
+        or len(codes) != len(user_queries)
+        or not all(isinstance(code, str) for code in codes)
+    ):
+        return None
+    return [clean_code(code).strip() for code in codes]
+
+
+def split_type_errors(output: str, files: Sequence[Path]) -> dict[Path, str]:
+    """Split the report from the type checker into the errors for each of the files.
+
+    An error starts with the path of the file and may continue on the following lines, e.g.
+    with the offending source line when the report is pretty-printed.  Errors in other
+    files and lines which can't be attributed to any file, like the summary, are left out.
+    The paths are compared after resolving them, as the type checker may print them relative
+    to the working directory.
+    """
+    paths = {file.resolve(): file for file in files}
+    errors: dict[Path, list[str]] = {}
+    current: list[str] | None = None
+    for line in output.splitlines(keepends=True):
+        if match := TYPE_ERROR_LOCATION_REGEX.match(line):
+            file = paths.get(Path(match["path"]).resolve())
+            current = None if file is None else errors.setdefault(file, [])
+        elif TYPE_CHECK_SUMMARY_REGEX.match(line):
+            current = None
+        if current is not None:
+            current.append(line)
+    return {file: "".join(lines) for file, lines in errors.items()}
+
+
+async def correct_type_errors(
+    backend: Backend,
+    conversations: dict[Path, list[dict[str, str]]],
+    code_file: Path,
+    errors: str,
+    user_query: str,
+    tries: int,
+    seen: set[tuple[str, str]],
+    test_retry: int = 0,
+) -> bool:
+    """Ask the programmer agent to correct the type errors in code_file.
+
+    The request continues the conversation about code_file in conversations, which is
+    started with the programmer if there is none.  If the conversation is with the test
+    designer, code_file is a test module and it is asked to correct that instead.
+
+    The failed attempt is kept in code_file.retry_<n>.bak together with its errors in
+    code_file.retry_<n>.type_errors.txt, or in code_file.test_retry_<m>.retry_<n>.bak and so
+    on when the code is type checked after test retry m.  Returns False without asking if
+    the same code has already failed with the same errors, as that would just waste an LLM
+    call, and if the agent answers with the same code, as it is then stuck.
+    """
+    code = await read_file(code_file)
+    # Keep the failed attempt and the type errors for debugging.
+    retry = f".test_retry_{test_retry}.retry_{tries}" if test_retry else f".retry_{tries}"
+    await write_file(code_file.with_suffix(f"{retry}.bak"), code)
+    await write_file(code_file.with_suffix(f"{retry}.type_errors.txt"), errors)
+    if (attempt := (digest(code), digest(errors))) in seen:
+        print(f"{code_file.name} has already failed type checking with the same errors.")
+        return False
+    seen.add(attempt)
+    messages = conversations.setdefault(code_file, [PROGRAMMER_SYSTEM_MESSAGE])
+    tests = messages[0] == TEST_DESIGNER_SYSTEM_MESSAGE
+    if continues_with(messages, code):
+        follow_up = TESTS_TYPE_ERRORS_FOLLOW_UP_PROMPT if tests else TYPE_ERRORS_FOLLOW_UP_PROMPT
+        prompt = follow_up.format(errors=errors)
+    else:
+        # Start the conversation over, the prompt has all that is needed.
+        del messages[1:]
+        full = TESTS_TYPE_ERRORS_PROMPT if tests else TYPE_ERRORS_PROMPT
+        prompt = full.format(user_query=user_query, code=code, errors=errors)
+    new_code = await programmer_agent(backend, messages, prompt)
+    # The first line of a test module imports the code, see run_tests_and_correct().
+    if tests and (import_line := code.partition("\n")[0]) not in new_code.splitlines():
+        new_code = f"{import_line}\n\n{new_code}"
+    if new_code == code:
+        print(f"The agent answered with the same code for {code_file.name}.")
+        return False
+    await write_file(code_file, new_code)
+    return True
+
+
+async def type_check_and_correct(
+    backend: Backend,
+    type_checker: TypeChecker,
+    conversations: dict[Path, list[dict[str, str]]],
+    files: Sequence[Path],
+    user_query: str,
+    max_retries: int,
+    context: Sequence[Path] = (),
+    test_retry: int = 0,
+) -> bool:
+    """In a loop: send the files to the type checker, if they pass, then return, else use an
+    agent to correct the files with errors.
 
+    All files are checked in a single run of the type checker, which is much faster than
+    checking them one by one.  The files in context are type checked together with the
+    files but are never changed, this is used to check the code against the tests.  If the
+    only errors are in the context, all of them are given to the agent for every file.
 
-def type_check_and_correct(
-    backend: Backend, code_file: Path, user_query: str, max_retries: int
-) -> Path | None:
-    """In a loop: send the code to mypy, if it passes, then return, else use an
-    agent to correct the code.
+    The corrected code is written back to the files, so that mypy's incremental cache can be
+    reused between retries.
 
-    returns A path to the updated (or unmodified) code if type checking passes
-    in <= max_retries iterations, otherwise returns None.
+    returns True if type checking passes in <= max_retries iterations, otherwise False.
 
     The user_query argument should be the query provided by the user, it is used to remind
-    the bot about the overall purpose of the code when correcting type errors.
+    the bot about the overall purpose of the code when correcting type errors.  test_retry
+    is the number of the test retry the code is checked after, if any, which is used to name
+    the files for debugging.
     """
-    orig_code_file = code_file
     tries: int = 0
+    seen: set[tuple[str, str]] = set()
     while tries <= max_retries:
-        # Run mypy on the code.
-        try:
-            subprocess.run(
-                ["mypy", code_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                check=True,
+        # Type check all files at once.
+        returncode, output = await type_checker.check(*files, *context)
+        if returncode == 0:
+            # The type checking was successful.
+            print(f"Successful type checking with {tries} retries.")
+            return True
+        # Type checking failed.
+        tries += 1
+        errors = split_type_errors(output, files) or dict.fromkeys(files, output)
+        corrected = await asyncio.gather(
+            *(
+                correct_type_errors(
+                    backend, conversations, file, file_errors, user_query, tries, seen, test_retry
+                )
+                for file, file_errors in errors.items()
             )
-        except subprocess.CalledProcessError as e:
-            # Type checking failed.
-            tries += 1
-            # Read the code from code_file.
-            with open(code_file) as f:
-                code: str = f.read()
-            # Write the type errors to a file.
-            with open(code_file.with_name(code_file.stem + "_type_errors.txt"), "w") as f:
-                f.write(e.stdout)
-            new_code = programmer_agent(
-                backend,
-                textwrap.dedent(f"""\
-                        The specification of the code is:
-                            {user_query}
+        )
+        if not all(corrected):
+            break
+    print(f"Failed type checking after {tries} tries.")
+    return False
 
-                        The code was:
-                        ```
-                        {code}
-                        ```
 
-                        However, type checking with mypy failed with the following errors:
-                            {e.stdout}
+async def test_designer_draft(backend: Backend, user_query: str) -> str:
+    """Draft tests from the query from the user alone, before the code has been written.
 
-                        Please correct the code to make it pass type checking.
-                    """),
-            )
-            # Write new_code to a file.
-            code_file = orig_code_file.with_stem(orig_code_file.stem + f"_types_retry_{tries}")
-            with open(code_file, "w") as f:
-                f.write(new_code)
-        else:
-            # The type checking was successful.
-            print(f"Successful type checking with {tries} retries.")
-            return code_file
-    print(f"Failed type checking after {tries} tries.")
+    This lets the tests be drafted at the same time as the code is written.  The draft
+    should be refined with test_designer_agent() once the code is available.
+    """
+    user_message = {"role": "user", "content": TEST_DRAFT_PROMPT.format(user_query=user_query)}
+    messages = [TEST_DESIGNER_SYSTEM_MESSAGE, user_message]
+    return await complete_code(backend, messages)
 
 
-def test_designer_agent(backend: Backend, code_file: Path, user_query: str) -> str:
+async def test_designer_agent(
+    backend: Backend, code: str, user_query: str, draft_tests: str | None = None
+) -> str:
     """Given the code from the code and the query from the user which describes
     the purpose of the code, write tests for it.
 
     We will first generate a stub file with all function definitions and docstrings,
-    then feed that to the LLM to generate tests.
+    then feed that to the LLM to generate tests.  If draft_tests is given, the LLM is
+    asked to adapt those to the stub rather than writing the tests from scratch.
 
-    Returns the test code, which should be in the same file as the code.
+    Returns the test code, which imports the code with `from <module> import *`.
     """
-    # Run stubgen to create the stub file.
-    subprocess.run(
-        ["stubgen", code_file, "--include-docstrings", "-o", code_file.parent],
-        stdout=subprocess.DEVNULL,
-        check=True,
-    )
-    # Read the stub file.
-    with open(code_file.with_suffix(".pyi")) as f:
-        stub: str = f.read()
+    stub: str = generate_stub(code)
     # Write the tests.
-    system_message = {
-        "role": "system",
-        "content": "You are a test designer. Write relevant Python unit tests to "
-        "verify the correctness of code solving the user's problem. Use the unit "
-        "test framework in Python. Provide only the test code, do not include "
-        "explanations. Write type annotations for the test code. "
-        "Use math.isnan() to check if a number is NaN. "
-        "Do not use any external libraries. "
-        "Do not try with very large inputs. "
-        "Do not replicate the function definitions.",
+    user_message = {
+        "role": "user",
+        "content": TEST_DESIGNER_PROMPT.format(user_query=user_query, stub=stub),
     }
+    if draft_tests is not None:
+        user_message["content"] += TEST_REFINE_PROMPT.format(draft_tests=draft_tests)
+    messages = [TEST_DESIGNER_SYSTEM_MESSAGE, user_message]
+    return await complete_code(backend, messages)
+
+
+async def test_designer_review(
+    backend: Backend, code: str, tests: str, user_query: str, errors: str
+) -> str:
+    """Ask the test designer agent whether the failing tests are wrong, rather than the code.
+
+    Returns the corrected tests, or the tests unchanged if they are right.
+    """
     user_message = {
         "role": "user",
-        "content": textwrap.dedent(f"""\
-            Problem:
-                {user_query}
-
-            The definitions of the functions to write tests for are as follows:
-            ```
-            {stub}
-            ```
-        """),
+        "content": TEST_REVIEW_PROMPT.format(
+            user_query=user_query, code=code, tests=tests, errors=errors
+        ),
     }
-    messages = [system_message, user_message]
-    test_code = backend.chat_completion(messages)
-    return clean_code(test_code)  # Clean the test code before returning
+    messages = [TEST_DESIGNER_SYSTEM_MESSAGE, user_message]
+    return await complete_code(backend, messages)
+
 
+async def review_tests(
+    backend: Backend, tests_file: Path, tests_header: str, code: str, user_query: str, errors: str
+) -> bool:
+    """Have the test designer agent review the tests in tests_file, which failed with errors.
 
-def run_tests_and_correct(
+    tests_header is the import of the code at the top of tests_file, which is left out of
+    the review.  The corrected tests are written to tests_file.  Returns True if the tests
+    were changed.
+    """
+    print("Asking the test designer to review the tests...")
+    tests = (await read_file(tests_file)).removeprefix(tests_header)
+    reviewed = await test_designer_review(backend, code, tests, user_query, errors)
+    if reviewed.strip() == tests.strip():
+        print("The test designer kept the tests.")
+        return False
+    await write_file(tests_file, f"{tests_header}{reviewed}\n")
+    return True
+
+
+async def type_check_and_run_tests(
     backend: Backend,
+    type_checker: TypeChecker,
+    conversations: dict[Path, list[dict[str, str]]],
+    files: Sequence[Path],
+    tests_file: Path,
+    user_query: str,
+    max_retries: int,
+    context: Sequence[Path] = (),
+    test_retry: int = 0,
+) -> tuple[int, str] | None:
+    """Type check and correct the files like type_check_and_correct() and run the tests.
+
+    The tests are started at the same time as the type checking, assuming that the files
+    already pass it.  If any of the files had to be corrected, the tests are cancelled and
+    run again with the corrected code.
+
+    Returns the exit code and the output of the tests, or None if type checking failed.
+    """
+    original = [await read_file(file) for file in files]
+    tests = asyncio.create_task(run_tests(tests_file))
+    try:
+        if not await type_check_and_correct(
+            backend,
+            type_checker,
+            conversations,
+            files,
+            user_query,
+            max_retries,
+            context,
+            test_retry,
+        ):
+            return None
+        if [await read_file(file) for file in files] != original:
+            tests.cancel()
+            return await run_tests(tests_file)
+        return await tests
+    finally:
+        tests.cancel()
+
+
+async def run_tests_and_correct(
+    backend: Backend,
+    type_checker: TypeChecker,
+    conversations: dict[Path, list[dict[str, str]]],
     code_file: Path,
     test_code: str,
     user_query: str,
     max_retries: int,
     interactive: bool,
 ) -> str | None:
-    """Given the code and the tests, merge them into the same python file and run
-    the unit tests in it. If the tests succeed, then return with the final code and tests,
-    else asks the LLM to rewrite the code to conform to the tests.
+    """Given the code and the tests, write the tests to tests.py next to the code and run
+    them. If the tests succeed, then return with the final code, else asks the LLM to
+    rewrite the code to conform to the tests.
+
+    The code and the tests must pass type checking before the test results are used, but
+    the tests are run at the same time as the type checking.
+
+    conversations holds the conversations with the programmer agent about each file, which
+    are continued when asking for corrections.  Type errors in the tests are corrected in a
+    conversation with the test designer agent.
 
-    Returns the final code and tests if successful, if failed after max_retries returns None.
+    If some test fails twice in a row, the tests may be wrong rather than the code, so the
+    test designer agent is asked to review them before the programmer agent is asked again.
+
+    Returns the final code if successful, if failed after max_retries returns None.
     """
-    orig_code_file = code_file
-    print("Type checking code...")
-    if (c := type_check_and_correct(backend, code_file, user_query, max_retries)) is not None:
-        code_file = c
-    else:
-        return
-    with open(code_file) as f:
-        code: str = f.read()
-    if interactive:
-        print("The code is:\n")
-        print(code)
-        input("Press enter to continue ")
-    test_code_separator: str = "## Tests"
+    tests_file = code_file.with_name("tests.py")
+    tests_header = f"from {code_file.stem} import *\n\n"
+    await write_file(tests_file, f"{tests_header}{test_code}\n")
+    conversations.setdefault(tests_file, [TEST_DESIGNER_SYSTEM_MESSAGE])
+    # First the code and the tests must pass type checking together, then only one of them
+    # is changed at a time.
+    files: list[Path] = [code_file, tests_file]
+    context: list[Path] = []
+    print("Type checking code and tests...")
     tries: int = 0
+    seen: set[tuple[str, str]] = set()
+    previously_failed: set[str] = set()
     while True:
-        # Check that the code and the tests passes type checking.
-        code_with_tests: str = code + "\n\n" + test_code_separator + "\n\n" + test_code
-        code_with_tests_file = code_file.with_stem(
-            orig_code_file.stem + "_with_tests" + (f"_retry_{tries}" if tries > 0 else "")
+        result = await type_check_and_run_tests(
+            backend,
+            type_checker,
+            conversations,
+            files,
+            tests_file,
+            user_query,
+            max_retries,
+            context,
+            tries,
         )
-        with open(code_with_tests_file, "w") as f:
-            f.write(code_with_tests)
-        print("Type checking code and tests...")
-        if (
-            c := type_check_and_correct(backend, code_with_tests_file, user_query, max_retries)
-        ) is not None:
-            code_with_tests_file = c
-        else:
+        if result is None:
             return None
-        with open(code_with_tests_file) as f:
-            code_with_tests = f.read()
-        # Split it into code and test_code.
-        try:
-            [code, test_code] = code_with_tests.split(test_code_separator)
-        except ValueError:
-            # It probably did only update the code.
-            code = code_with_tests
-            code_with_tests = code + "\n\n" + test_code_separator + "\n\n" + test_code
-            with open(code_with_tests_file, "w") as f:
-                f.write(code_with_tests)
-        code = code.strip()
-        test_code = test_code.strip()
-        # Run the tests using unittest
-        try:
-            subprocess.run(
-                ["python", "-m", "unittest", code_with_tests_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            # Tests failed
-            tries += 1
-            # Write test errors to a file.
-            with open(
-                code_with_tests_file.with_name(code_with_tests_file.stem + "_errors.txt"), "w"
-            ) as f:
-                f.write(e.stdout)
-            print("The tests failed:")
-            print(textwrap.indent(e.stdout, " " * 4))
-            if tries > max_retries:
-                print(f"Failed testing after {tries} tries.")
-                break
-            if interactive:
-                print("We will ask the agent to update the code.")
-                input("Press enter to continue. ")
-            # Ask programmer agent to update the code.
-            print("Updating the code...")
-            code = programmer_agent(
-                backend,
-                textwrap.dedent(f"""\
-                        The specification of the code is:
-                            {user_query}
-
-                        The code was:
-                        ```
-                        {code}
-                        ```
-
-                        However, the tests failed with the following errors:
-                            {e.stdout}
-
-                        Please correct the code to make it pass the tests.
-                    """),
-            )
-            if interactive:
-                print("The code has been updated to:\n")
-                print(code)
-                input("Press enter to continue ")
+        returncode, output = result
+        code = await read_file(code_file)
+        if interactive:
+            print("The code is:\n" if tries == 0 else "The code has been updated to:\n")
+            print(code)
+            input("Press enter to continue ")
+        if tries > 0:
             print("\n", "-" * 10, f" Retry {tries} ", "-" * 50)
-        else:
+        if returncode == 0:
             # Tests succeeded!
             print(f"The tests passed after {tries} retries.")
             print("The final code is:\n")
             print(code)
             return code
+        # Tests failed
+        tries += 1
+        # Keep the failed attempt and the test errors for debugging.
+        await write_file(code_file.with_suffix(f".test_retry_{tries}.bak"), code)
+        await write_file(code_file.with_suffix(f".test_retry_{tries}.errors.txt"), output)
+        print("The tests failed:")
+        print(textwrap.indent(output, " " * 4))
+        if tries > max_retries:
+            print(f"Failed testing after {tries} tries.")
+            break
+        failed = set(UNITTEST_FAILURE_REGEX.findall(output))
+        if reviewed := bool(failed & previously_failed):
+            print("The same tests failed again.")
+            if await review_tests(backend, tests_file, tests_header, code, user_query, output):
+                # Check that the corrected tests pass type checking together with the code.
+                files, context = [tests_file], [code_file]
+                previously_failed = set()
+                print("Type checking tests...")
+                continue
+        previously_failed = failed
+        # Asking again with the same code and errors would just waste an LLM call.
+        errors = UNITTEST_TIMING_REGEX.sub(r"\1", output)
+        if (attempt := (digest(code), digest(errors))) in seen:
+            print("The same code has already failed the tests with the same errors.")
+            break
+        seen.add(attempt)
+        if interactive:
+            print("We will ask the agent to update the code.")
+            input("Press enter to continue. ")
+        # Ask programmer agent to update the code.
+        print("Updating the code...")
+        messages = conversations.setdefault(code_file, [PROGRAMMER_SYSTEM_MESSAGE])
+        if continues_with(messages, code):
+            prompt = TEST_ERRORS_FOLLOW_UP_PROMPT.format(errors=output)
+        else:
+            # Start the conversation over, the prompt has all that is needed.
+            del messages[1:]
+            prompt = TEST_ERRORS_PROMPT.format(user_query=user_query, code=code, errors=output)
+        new_code = await programmer_agent(backend, messages, prompt)
+        if new_code == code:
+            # The programmer is stuck, and the tests would fail in the same way again, so
+            # they may be wrong, unless the test designer has just kept them.
+            print("The programmer answered with the same code.")
+            if reviewed or not await review_tests(
+                backend, tests_file, tests_header, code, user_query, output
+            ):
+                break
+            files, context = [tests_file], [code_file]
+            previously_failed = set()
+            print("Type checking tests...")
+            continue
+        await write_file(code_file, new_code)
+        # Check that the updated code passes type checking together with the tests.
+        files, context = [code_file], [tests_file]
+        print("Type checking code...")
+    return None
 
 
-def run(user_query: str, backend: Backend, max_retries: int, interactive: bool) -> str:
-    # Programmer writes code
-    code: str = programmer_agent(
-        backend,
-        textwrap.dedent(f"""\
-            Problem:
-                {user_query}
+async def run(
+    user_query: str,
+    backend: Backend,
+    max_retries: int,
+    interactive: bool,
+    target_dir: Path = Path("target") / "coder_agent",
+    code: str | None = None,
+    type_checker: str = "mypy",
+) -> str:
+    """Solve the problem in user_query and return the final code.
 
-            Write functions with type annotations which could solve the user's problem.
-        """),
-    )
-    target_dir = Path("target") / "coder_agent"
+    All intermediate files are written to target_dir, which is cleared first.  If code is
+    given, it is used as the programmer's first attempt instead of asking the programmer agent.
+    type_checker is the name of the type checker to use, see make_type_checker().
+    """
+    draft_tests: str | None = None
+    messages = [PROGRAMMER_SYSTEM_MESSAGE]
+    problem = PROBLEM_PROMPT.format(user_query=user_query)
+    if code is None:
+        # Programmer writes code while the test designer drafts tests from the problem alone.
+        draft_task = asyncio.create_task(test_designer_draft(backend, user_query))
+        try:
+            code = await programmer_agent(backend, messages, problem)
+            draft_tests = await draft_task
+        finally:
+            draft_task.cancel()
+    else:
+        messages += [{"role": "user", "content": problem}, {"role": "assistant", "content": code}]
     if target_dir.is_dir():
         shutil.rmtree(target_dir)
+    forget_files(target_dir)
     target_dir.mkdir(parents=True)
-    code_file = target_dir / "code.py"
-    with open(code_file, "w") as f:
-        f.write(code)
-    test_code: str = test_designer_agent(backend, code_file, user_query)
-    return (
-        run_tests_and_correct(backend, code_file, test_code, user_query, max_retries, interactive)
-        or ""
-    )
+    # Not code.py, as the tests would then import the code module from the standard library.
+    code_file = target_dir / "solution.py"
+    await write_file(code_file, code)
+    test_code: str = await test_designer_agent(backend, code, user_query, draft_tests)
+    checker = make_type_checker(type_checker, target_dir)
+    try:
+        return (
+            await run_tests_and_correct(
+                backend,
+                checker,
+                {code_file: messages},
+                code_file,
+                test_code,
+                user_query,
+                max_retries,
+                interactive,
+            )
+            or ""
+        )
+    finally:
+        await checker.close()
+        forget_files(target_dir)
+
+
+async def run_human_eval(
+    backend: Backend,
+    max_retries: int,
+    concurrency: int,
+    batch_size: int,
+    max_samples: int | None,
+    batch_backend: OpenaiBatchBackend | None = None,
+    type_checker: str = "mypy",
+) -> None:
+    """Solve the HumanEval problems and write the completions to samples.jsonl.
+
+    At most `concurrency` problems are solved at the same time, each in its own directory
+    under target/human_eval.  The programmer's first attempts are requested for `batch_size`
+    problems at a time, or for all problems at once through the Batch API if `batch_backend`
+    is given.
+    """
+    problems = human_eval.data.read_problems()
+    print(f"Found {len(problems)} problems.")
+    task_ids = list(problems)[:max_samples]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def solve(task_id: str, code: str | None) -> dict[str, str]:
+        async with semaphore:
+            completion = await run(
+                problems[task_id]["prompt"],
+                backend,
+                max_retries,
+                interactive=False,
+                target_dir=Path("target") / "human_eval" / task_id.replace("/", "_"),
+                code=code,
+                type_checker=type_checker,
+            )
+        return dict(task_id=task_id, completion=completion)
+
+    async def solve_batch(batch: list[str]) -> list[dict[str, str]]:
+        codes: Sequence[str | None] = [None] * len(batch)
+        if len(batch) > 1:
+            async with semaphore:
+                codes = (
+                    await programmer_agent_batch(
+                        backend, [problems[task_id]["prompt"] for task_id in batch]
+                    )
+                    or codes
+                )
+        return await asyncio.gather(*map(solve, batch, codes))
+
+    if batch_backend is not None:
+        print("Waiting for the first attempts from the Batch API.")
+        codes = await programmer_agent_batch_api(
+            batch_backend, [problems[task_id]["prompt"] for task_id in task_ids]
+        )
+        samples = await asyncio.gather(*map(solve, task_ids, codes))
+    else:
+        batches = await asyncio.gather(
+            *(
+                solve_batch(task_ids[i : i + batch_size])
+                for i in range(0, len(task_ids), batch_size)
+            )
+        )
+        samples = [sample for batch in batches for sample in batch]
+    human_eval.data.write_jsonl("samples.jsonl", samples)
 
 
 def main() -> None:
@@ -310,6 +918,21 @@ def main() -> None:
     )
     argparser.add_argument("-m", "--model", help="Name of the specific model for the backend.")
     argparser.add_argument("--max-tokens", type=int, default=1500, help="Maximum number of tokens.")
+    argparser.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Cache LLM responses in memory and in target/llm_cache.sqlite across runs.  Only "
+        "used at temperature 0.",
+    )
+    argparser.add_argument(
+        "--semantic-cache",
+        type=float,
+        metavar="THRESHOLD",
+        help="Reuse the response to an earlier request if the embeddings of the messages have "
+        "at least this cosine similarity, e.g. 0.92.  Embeddings are stored in "
+        "target/llm_semantic_cache.sqlite and need an OpenAI API key.",
+    )
     argparser.add_argument(
         "--human-eval",
         action="store_true",
@@ -318,36 +941,101 @@ def main() -> None:
     argparser.add_argument(
         "--human-eval-samples", type=int, help="Solve at most this number of problems."
     )
+    argparser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of human-eval problems to solve concurrently.",
+    )
+    argparser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of human-eval problems to request first attempts for in a single prompt.  "
+        "The answers share --max-tokens, which must be raised accordingly.",
+    )
+    argparser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Request the first attempts for human-eval through OpenAI's Batch API, which is "
+        "cheaper but may take hours.",
+    )
+    argparser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=500,
+        help="Rate limit per API key when several keys are given, see the README.",
+    )
+    argparser.add_argument(
+        "--type-checker",
+        choices=["mypy", "dmypy", "ty"],
+        default="mypy",
+        help="Run mypy in-process, keep a mypy daemon running while a problem is solved, "
+        "which makes the type checks after a correction faster, or run ty, which is faster "
+        "still but must be installed separately.",
+    )
     args = argparser.parse_args()
+    if args.type_checker != "mypy" and shutil.which(args.type_checker) is None:
+        print(f"{args.type_checker} was not found, falling back to mypy.")
+        args.type_checker = "mypy"
+    if args.batch_api and args.backend != "openai":
+        exit("--batch-api requires the openai backend.")
+    backend_class: type[GroqBackend] | type[OpenaiBackend]
     if args.backend == "groq":
-        backend = GroqBackend()
+        backend_class, key_variable = GroqBackend, "GROQ_API_KEY"
     elif args.backend == "openai":
-        backend = OpenaiBackend()
+        backend_class = OpenaiBatchBackend if args.batch_api else OpenaiBackend
+        key_variable = "OPENAI_API_KEY"
     else:
         exit(f"Bad backend: {args.backend}")
+    # Without numbered keys the SDK reads the usual environment variable.
+    llms: list[Backend] = [backend_class(api_key=key) for key in api_keys(key_variable)]
+    if not llms:
+        llms = [backend_class()]
+    backend: Backend = (
+        RoundRobinBackend(llms, args.requests_per_minute) if len(llms) > 1 else llms[0]
+    )
     backend.max_tokens = args.max_tokens
     backend.temperature = args.temperature
     if args.model is not None:
         backend.model = args.model
+    # The Batch API has its own rate limits, so one key is enough.
+    batch_backend = llms[0] if isinstance(llms[0], OpenaiBatchBackend) else None
+    if args.semantic_cache is not None:
+        backend = SemanticCachedBackend(
+            backend, args.semantic_cache, Path("target") / "llm_semantic_cache.sqlite"
+        )
+    if args.cache:
+        backend = CachedBackend(backend, SQLiteCache(Path("target") / "llm_cache.sqlite"))
     if args.human_eval:
-        problems = human_eval.data.read_problems()
-        print(f"Found {len(problems)} problems.")
-        samples = []
-        for i, task_id in enumerate(problems):
-            if args.human_eval_samples is not None and args.human_eval_samples <= i:
-                break
-            samples.append(
-                dict(
-                    task_id=task_id,
-                    completion=run(
-                        problems[task_id]["prompt"], backend, args.retries, interactive=False
-                    ),
-                )
+        asyncio.run(
+            run_human_eval(
+                backend,
+                args.retries,
+                args.concurrency,
+                args.batch_size,
+                args.human_eval_samples,
+                batch_backend,
+                args.type_checker,
             )
-        human_eval.data.write_jsonl("samples.jsonl", samples)
+        )
     else:
         user_query: str = input("Enter your query: ")
-        run(user_query, backend, args.retries, interactive=not args.no_interactive)
+        asyncio.run(
+            run(
+                user_query,
+                backend,
+                args.retries,
+                interactive=not args.no_interactive,
+                type_checker=args.type_checker,
+            )
+        )
+    print(
+        f"Sent {sum(llm.prompt_tokens for llm in llms)} prompt tokens, "
+        f"{sum(llm.cached_prompt_tokens for llm in llms)} of which were served from the "
+        "provider's prompt cache."
+    )
 
 
 if __name__ == "__main__":
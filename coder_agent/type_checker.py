@@ -0,0 +1,207 @@
+import asyncio
+import atexit
+import hashlib
+import subprocess
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mypy.api
+
+from .files import read_file
+
+MYPY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mypy")
+"""Mypy runs in-process, and its build must not run in two threads at once, so all runs are
+queued for a single thread.  Waiting runs then don't hold threads needed for other work."""
+
+MYPY_OPTIONS = ["--pretty", "--ignore-missing-imports", "--no-color-output", "--no-error-summary"]
+"""The options for both mypy and the daemon.  Missing third-party modules are left to the
+tests, and the summary is left out of the report which is given to the programmer."""
+
+
+class TypeChecker(ABC):
+    """A static type checker for the generated code."""
+
+    @abstractmethod
+    async def check(self, *files: Path) -> tuple[int, str]:
+        """Type check the files together.
+
+        Returns the exit status, which is 0 if there were no errors, and the report.
+        """
+
+    async def close(self) -> None:
+        """Release any resources held by the type checker."""
+        return
+
+
+class Mypy(TypeChecker):
+    """Runs mypy in-process in the mypy thread.
+
+    The incremental cache in cache_dir is reused across calls, so the typeshed is only
+    analyzed once.  It is kept apart from the cache of the project itself.  The cache is
+    shared by all problems, whose modules have the same names, solution and tests, so a
+    check of one problem replaces the cache entries of the previous one.  Only the analysis
+    of the typeshed and installed packages is saved, but the generated modules are small
+    and depend on each other, so they would mostly be analyzed again anyway.
+    """
+
+    cache_dir: Path
+
+    def __init__(self, cache_dir: Path = Path("target") / ".mypy_cache") -> None:
+        self.cache_dir = cache_dir
+
+    async def check(self, *files: Path) -> tuple[int, str]:
+        return await asyncio.get_running_loop().run_in_executor(MYPY_EXECUTOR, self.run, *files)
+
+    def run(self, *files: Path) -> tuple[int, str]:
+        """Run mypy on the files.  This blocks, and must only be called in the mypy thread."""
+        stdout, stderr, status = mypy.api.run([
+            *map(str, files),
+            *MYPY_OPTIONS,
+            # The files are checked against the typeshed and installed packages, but errors
+            # in those are of no interest.
+            "--follow-imports=silent",
+            "--incremental",
+            "--cache-dir",
+            str(self.cache_dir),
+        ])
+        return status, stdout + stderr
+
+
+class Dmypy(TypeChecker):
+    """Runs the mypy daemon, which keeps the typeshed and the results for unchanged modules in
+    memory, so that checking the same files again after a correction is fast.
+
+    The daemon is started on the first check and stopped by close(), or at exit if close()
+    is never called.  It tells modules apart by name only, so a daemon must only be used for
+    the files in one directory.  Imports are not followed, as the daemon crashes when a new
+    file imports modules which were not in the first build, so all local modules must be
+    passed to check().  If the daemon crashes anyway, mypy is used instead.
+    """
+
+    status_file: Path
+    lock: asyncio.Lock
+    started: bool = False
+    fallback: Mypy | None = None
+
+    def __init__(self, directory: Path) -> None:
+        self.status_file = directory / ".dmypy.json"
+        self.lock = asyncio.Lock()
+
+    async def check(self, *files: Path) -> tuple[int, str]:
+        if self.fallback is not None:
+            return await self.fallback.check(*files)
+        async with self.lock:
+            if not self.started:
+                self.started = True
+                atexit.register(self.stop)
+            process = await asyncio.create_subprocess_exec(
+                *("dmypy", "--status-file", self.status_file, "run", "--timeout", "3600", "--"),
+                "--follow-imports=skip",
+                *MYPY_OPTIONS,
+                *files,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            stdout, _ = await process.communicate()
+        output = stdout.decode().removeprefix("Daemon started\n")
+        if "Daemon crashed!" in output:
+            # Don't pass the traceback on to the programmer as type errors.
+            self.fallback = Mypy()
+            return await self.fallback.check(*files)
+        assert process.returncode is not None
+        return process.returncode, output
+
+    async def close(self) -> None:
+        async with self.lock:
+            if self.started:
+                await asyncio.to_thread(self.stop)
+
+    def stop(self) -> None:
+        """Stop the daemon if it is running.  This blocks."""
+        if not self.started:
+            return
+        self.started = False
+        atexit.unregister(self.stop)
+        subprocess.run(
+            ["dmypy", "--status-file", self.status_file, "stop"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+class Ty(TypeChecker):
+    """Runs ty, Astral's type checker, which is much faster than mypy but still in preview.
+
+    The ty executable must be installed separately.  The report is given in the concise
+    format, with one line per error like mypy's, and missing modules are left to the tests.
+    """
+
+    directory: Path
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    async def check(self, *files: Path) -> tuple[int, str]:
+        process = await asyncio.create_subprocess_exec(
+            *("ty", "check", "--output-format", "concise", "--color", "never"),
+            *("--ignore", "unresolved-import"),
+            # The files import each other.
+            *("--extra-search-path", self.directory),
+            *files,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        stdout, _ = await process.communicate()
+        assert process.returncode is not None
+        return process.returncode, stdout.decode()
+
+
+class CachedTypeChecker(TypeChecker):
+    """Wraps another type checker and reuses its result when the same files are checked again
+    with the same content, e.g. when a correction only changed the tests or the programmer
+    answered with code which has already been checked.
+    """
+
+    checker: TypeChecker
+    results: dict[bytes, tuple[int, str]]
+
+    def __init__(self, checker: TypeChecker) -> None:
+        self.checker = checker
+        self.results = {}
+
+    async def key(self, *files: Path) -> bytes:
+        """Hash the paths and the contents of the files."""
+        digest = hashlib.blake2b(digest_size=16)
+        for file in files:
+            text = await read_file(file)
+            digest.update(str(file).encode() + b"\0")
+            digest.update(hashlib.blake2b(text.encode(), digest_size=16).digest())
+        return digest.digest()
+
+    async def check(self, *files: Path) -> tuple[int, str]:
+        key = await self.key(*files)
+        if (result := self.results.get(key)) is None:
+            result = self.results[key] = await self.checker.check(*files)
+        return result
+
+    async def close(self) -> None:
+        await self.checker.close()
+
+
+def make_type_checker(name: str, directory: Path) -> TypeChecker:
+    """Create the type checker called `name` for the files in directory.
+
+    The results are cached, so the files must not import anything which may change, other
+    than each other.
+    """
+    checker: TypeChecker
+    if name == "mypy":
+        checker = Mypy()
+    elif name == "dmypy":
+        checker = Dmypy(directory)
+    elif name == "ty":
+        checker = Ty(directory)
+    else:
+        raise ValueError(f"Unknown type checker: {name}")
+    return CachedTypeChecker(checker)